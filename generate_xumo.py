@@ -1,16 +1,28 @@
 # -*- coding: utf-8 -*-
 import requests
+from requests.adapters import HTTPAdapter
+try: import aiohttp # Concurrent EPG page fetching
+except ImportError: aiohttp = None # Fallback: run fetch_data in worker threads
+import asyncio
+import contextlib
+import hashlib # Response cache keys
 import json
+try: from orjson import loads as json_loads # Decodes response bytes directly, several times faster than json.loads
+except ImportError: json_loads = json.loads # Fallback: stdlib (also accepts bytes)
 import os
 import gzip
+import io
 from datetime import datetime, timedelta, timezone
-import xml.etree.ElementTree as ET
 import logging
 import time
 import re
 import uuid # Needed for IFA placeholder
 import sys
 import math # For calculating total pages
+from concurrent.futures import ThreadPoolExecutor # Concurrent per-channel stream URL lookups
+from collections import namedtuple # Compact EPG programme records
+from functools import lru_cache # Memoize repeated EPG timestamp parsing
+from xml.sax.saxutils import escape as xml_escape_text # Channel and programme XML is emitted as pre-escaped strings
 
 # --- Configuration ---
 ANDROID_TV_ENDPOINT = "https://android-tv-mds.xumo.com/v2" # Keep for asset/broadcast lookups
@@ -33,51 +45,147 @@ ASSET_DETAILS_URL_TEMPLATE = f"{ASSET_LOOKUP_ENDPOINT}/assets/asset/{{asset_id}}
 EPG_FETCH_URL_TEMPLATE = f"{VALENCIA_API_ENDPOINT}/epg/{PRIMARY_LIST_ID}/{{date_str}}/{{hour}}.json?limit=50&offset={{offset}}&f=asset.title&f=asset.descriptions"
 
 XUMO_LOGO_URL_TEMPLATE = "https://image.xumo.com/v1/channels/channel/{channel_id}/168x168.png?type=color_onBlack"
+XUMO_LOGO_URL_PREFIX, XUMO_LOGO_URL_SUFFIX = XUMO_LOGO_URL_TEMPLATE.split("{channel_id}") # {channel_id} is the only token
+DRM_CALLSIGN_SUFFIXES = ("-DRM", "DRM-CMS") # Callsigns of DRM-protected channels end with one of these (single tuple endswith)
 
 # --- Script Settings ---
 EPG_FETCH_DAYS = 2
 MAX_EPG_OFFSET = 350
 HOURS_TO_FETCH = 24
-API_DELAY_SECONDS = 0.10
+STREAM_LOOKUP_CONCURRENCY = 16 # Channels whose stream URL is looked up at once (replaces the per-channel API delay)
+EPG_MAX_EMPTY_OFFSET_BLOCKS = 2 # Stop walking offsets for a date after this many consecutive blocks without any channels
+EPG_FETCH_CONCURRENCY = 20 # Max EPG page requests in flight at once (replaces the per-request sleeps in fetch_epg_data)
 OUTPUT_DIR = "playlists"
 PLAYLIST_FILENAME = "xumo_playlist.m3u"
 EPG_FILENAME = "xumo_epg.xml.gz"
 REQUEST_TIMEOUT = 45
+RETRY_AFTER_MAX_SECONDS = 30 # Cap on a server-sent Retry-After before retrying a 429 (requests are otherwise never throttled)
+LOG_LEVEL = logging.INFO # logging.DEBUG traces every request and EPG page (hot-path debug messages are only formatted at DEBUG)
+RESPONSE_CACHE_DIR = ".xumo_cache" # On-disk cache of successful JSON responses (channel list, asset details, EPG pages)
+RESPONSE_CACHE_TTL = 3600 # Seconds a cached response stays valid; 0 disables the cache
 
 # !!! GitHub Repo Info !!!
 GITHUB_USER = "BuddyChewChew"
 GITHUB_REPO = "xumo-playlist-generator"
 GITHUB_BRANCH = "main"
 EPG_RAW_URL = f"https://raw.githubusercontent.com/{GITHUB_USER}/{GITHUB_REPO}/{GITHUB_BRANCH}/{OUTPUT_DIR}/{EPG_FILENAME}"
+XMLTV_GENERATOR_NAME = f"{GITHUB_USER}-{GITHUB_REPO}"
+
+# --- Pre-encoded output headers (computed once at import) ---
+M3U_HEADER = f'#EXTM3U url-tvg="{EPG_RAW_URL}"\n'.encode('utf-8')
+XMLTV_TV_OPEN_TAG = f'<tv generator-info-name="{XMLTV_GENERATOR_NAME}">'.encode('utf-8')
 
 # --- Headers ---
 WEB_HEADERS = { 'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.0.0 Safari/537.36', 'Accept': 'application/json, text/plain, */*', 'Accept-Language': 'en-US,en;q=0.9', 'Origin': 'https://play.xumo.com', 'Referer': 'https://play.xumo.com/', }
 # Use Android TV Headers for Asset/Broadcast lookup calls
 ANDROID_TV_HEADERS = { 'User-Agent': 'okhttp/4.9.3', }
 
+# --- HTTP Session ---
+# One shared Session keeps TCP/TLS connections alive across the hundreds of small API calls.
+# Headers stay per-request (WEB_HEADERS vs ANDROID_TV_HEADERS) so they are never merged.
+HTTP_POOL_SIZE = 32 # >= EPG_FETCH_CONCURRENCY and STREAM_LOOKUP_CONCURRENCY so threaded fetches never wait on a connection
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE, max_retries=0))
+SESSION.mount('http://', HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE, max_retries=0))
+
 # --- Logging Setup ---
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - [%(funcName)s] %(message)s', stream=sys.stdout)
+logging.basicConfig(level=LOG_LEVEL, format='%(asctime)s - %(levelname)s - [%(funcName)s] %(message)s', stream=sys.stdout)
 
 
 # --- Helper Functions ---
 
-def fetch_data(url, params=None, is_json=True, retries=2, delay=2, headers=WEB_HEADERS): # Default to Web Headers
-    """Fetches data from a URL, handles JSON parsing and errors, includes retries."""
-    logging.debug(f"URL: {url}, Params: {params}")
+def response_cache_path(url, params=None):
+    key = hashlib.sha1(repr((url, sorted(params.items()) if params else None)).encode('utf-8')).hexdigest()
+    return os.path.join(RESPONSE_CACHE_DIR, f"{key}.json.gz")
+
+def read_cached_json(url, params=None, ttl=RESPONSE_CACHE_TTL):
+    """Returns the cached JSON for url if it is younger than ttl seconds, else None."""
+    if not ttl: return None
+    path = response_cache_path(url, params)
+    try:
+        if time.time() - os.path.getmtime(path) > ttl: return None
+        with gzip.open(path, 'rb') as f: data = json_loads(f.read())
+        if logging.getLogger().isEnabledFor(logging.DEBUG): logging.debug(f"Cache hit: {url}")
+        return data
+    except FileNotFoundError: return None
+    except (OSError, ValueError) as e: logging.debug(f"Ignoring unreadable cache entry for {url}: {e}"); return None
+
+def write_cached_json(url, data, params=None, ttl=RESPONSE_CACHE_TTL, validators=None):
+    """Stores a successful JSON response; written to a temp file first so concurrent readers never see partial data.
+    validators (see response_validators) are kept next to it so the entry can be revalidated once it has expired."""
+    if not ttl or data is None: return
+    path = response_cache_path(url, params); tmp_path = f"{path}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
+    try:
+        os.makedirs(RESPONSE_CACHE_DIR, exist_ok=True)
+        with gzip.open(tmp_path, 'wb', compresslevel=1) as f: f.write(json.dumps(data).encode('utf-8'))
+        os.replace(tmp_path, path)
+        if validators:
+            with open(tmp_path, 'w') as f: json.dump(validators, f)
+            os.replace(tmp_path, f"{path}.validators")
+        else:
+            with contextlib.suppress(FileNotFoundError): os.remove(f"{path}.validators")
+    except (OSError, TypeError, ValueError) as e:
+        logging.debug(f"Could not cache response for {url}: {e}")
+        with contextlib.suppress(OSError): os.remove(tmp_path)
+
+def response_validators(response_headers):
+    """Conditional request headers (If-None-Match / If-Modified-Since) for a response's ETag / Last-Modified."""
+    validators = {}
+    if response_headers.get('ETag'): validators['If-None-Match'] = response_headers['ETag']
+    if response_headers.get('Last-Modified'): validators['If-Modified-Since'] = response_headers['Last-Modified']
+    return validators
+
+def read_cache_validators(url, params=None):
+    """Returns the conditional request headers stored with a (possibly expired) cache entry, or {}."""
+    try:
+        with open(f"{response_cache_path(url, params)}.validators") as f: return json.load(f)
+    except (OSError, ValueError): return {}
+
+def revalidate_cached_json(url, params=None):
+    """After a 304 Not Modified: returns the cached JSON for url regardless of age and restarts its TTL, else None."""
+    path = response_cache_path(url, params)
+    try:
+        with gzip.open(path, 'rb') as f: data = json_loads(f.read())
+        os.utime(path); os.utime(f"{path}.validators")
+        if logging.getLogger().isEnabledFor(logging.DEBUG): logging.debug(f"Cache revalidated (304): {url}")
+        return data
+    except (OSError, ValueError) as e: logging.debug(f"Could not reuse cache entry for {url} after 304: {e}"); return None
+
+def retry_after_seconds(response_headers, default):
+    """Seconds to wait before retrying a 429: the Retry-After header (delta-seconds form) capped at RETRY_AFTER_MAX_SECONDS, else default."""
+    retry_after = (response_headers.get('Retry-After') or '').strip()
+    return min(int(retry_after), RETRY_AFTER_MAX_SECONDS) if retry_after.isdigit() else default
+
+def fetch_data(url, params=None, is_json=True, retries=2, delay=2, headers=WEB_HEADERS, cache_ttl=0): # Default to Web Headers
+    """Fetches data from a URL, handles JSON parsing and errors, includes retries.
+    With cache_ttl > 0, successful JSON responses are served from / stored in the on-disk response cache."""
+    log_debug = logging.getLogger().isEnabledFor(logging.DEBUG) # Checked once; per-request debug messages are only formatted when emitted
+    if log_debug: logging.debug(f"URL: {url}, Params: {params}")
+    if is_json and cache_ttl:
+        cached = read_cached_json(url, params, cache_ttl)
+        if cached is not None: return cached
+    # An expired cache entry with an ETag/Last-Modified is revalidated: an unchanged response comes back as an empty 304
+    conditional_headers = read_cache_validators(url, params) if is_json and cache_ttl else {}
     # logging.debug(f"Headers: {json.dumps(headers)}") # Can be verbose
     for attempt in range(retries + 1):
         try:
             # Pass specific headers for the call
-            response = requests.get(url, headers=headers, params=params, timeout=REQUEST_TIMEOUT, allow_redirects=True)
-            logging.debug(f"Request URL: {response.url} -> Status: {response.status_code}")
+            response = SESSION.get(url, headers={**headers, **conditional_headers} if conditional_headers else headers, params=params, timeout=REQUEST_TIMEOUT, allow_redirects=True)
+            if log_debug: logging.debug(f"Request URL: {response.url} -> Status: {response.status_code}")
+            if response.status_code == 304 and conditional_headers:
+                data = revalidate_cached_json(url, params)
+                if data is not None: return data
+                conditional_headers = {}; continue # Cached body is gone: retry unconditionally
             response.raise_for_status()
             if is_json:
                 if not response.content: logging.warning(f"Empty response content received from {url}"); return None
-                try: return response.json()
+                try: data = json_loads(response.content) # Skips requests' charset detection
                 except json.JSONDecodeError as e_final:
-                    logging.error(f"Error decoding JSON. Content: {response.text[:500]}... - {e_final}")
-                    if logging.getLogger().level == logging.DEBUG: logging.debug(f"Full Text:\n{response.text}")
+                    logging.error(f"Error decoding JSON. Content: {response.content[:500].decode('utf-8', errors='replace')}... - {e_final}")
+                    if log_debug: logging.debug(f"Full Text:\n{response.text}")
                     return None
+                if cache_ttl: write_cached_json(url, data, params, cache_ttl, response_validators(response.headers))
+                return data
             else:
                  try:
                      decoded_text = response.content.decode('utf-8', errors='ignore')
@@ -87,9 +195,10 @@ def fetch_data(url, params=None, is_json=True, retries=2, delay=2, headers=WEB_H
                  except Exception as decode_ex: logging.error(f"Error decoding text response: {decode_ex}"); return None
         except requests.exceptions.HTTPError as e:
             logging.warning(f"Attempt {attempt+1}/{retries+1} HTTP Error: {e}")
-            if response is not None: logging.warning(f"Error Response Content: {response.text[:500]}...")
-            # Don't retry 404
-            if attempt < retries and response is not None and response.status_code not in [401, 403, 404, 429]:
+            if response is not None: logging.warning(f"Error Response Content: {response.content[:500].decode('utf-8', errors='replace')}...")
+            # Don't retry 404; 429 is retried only after the wait the server asks for
+            if attempt < retries and response is not None and response.status_code == 429: time.sleep(retry_after_seconds(response.headers, delay * (attempt + 1)))
+            elif attempt < retries and response is not None and response.status_code not in [401, 403, 404, 429]:
                 time.sleep(delay * (attempt + 1))
             elif attempt == retries: logging.error(f"Final attempt failed with HTTP Error: {e}"); return None
             else: break # Non-retriable HTTP error or final attempt failed (like 404)
@@ -99,9 +208,81 @@ def fetch_data(url, params=None, is_json=True, retries=2, delay=2, headers=WEB_H
             elif attempt == retries: logging.error(f"Final attempt failed with Network Error: {e}"); return None
     return None
 
+async def fetch_data_async(session, url, retries=2, delay=2, cache_ttl=0):
+    """aiohttp counterpart of fetch_data (JSON only) with the same retry, caching and logging behaviour. Returns None on failure."""
+    log_debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+    if log_debug: logging.debug(f"URL: {url}")
+    if cache_ttl:
+        cached = read_cached_json(url, ttl=cache_ttl)
+        if cached is not None: return cached
+    conditional_headers = read_cache_validators(url) if cache_ttl else {}
+    for attempt in range(retries + 1):
+        try:
+            async with session.get(url, headers=conditional_headers or None, allow_redirects=True) as response:
+                if log_debug: logging.debug(f"Request URL: {response.url} -> Status: {response.status}")
+                if response.status == 304 and conditional_headers:
+                    data = revalidate_cached_json(url)
+                    if data is not None: return data
+                    conditional_headers = {}; continue # Cached body is gone: retry unconditionally
+                if response.status >= 400:
+                    error_text = (await response.read())[:500].decode('utf-8', errors='replace')
+                    logging.warning(f"Attempt {attempt+1}/{retries+1} HTTP Error: {response.status} {response.reason} for url: {response.url}")
+                    logging.warning(f"Error Response Content: {error_text}...")
+                    # Don't retry 404; 429 is retried only after the wait the server asks for
+                    if attempt < retries and response.status == 429: await asyncio.sleep(retry_after_seconds(response.headers, delay * (attempt + 1))); continue
+                    if attempt < retries and response.status not in [401, 403, 404, 429]: await asyncio.sleep(delay * (attempt + 1)); continue
+                    if attempt == retries: logging.error(f"Final attempt failed with HTTP Error: {response.status} {response.reason}")
+                    return None
+                content = await response.read()
+                if not content: logging.warning(f"Empty response content received from {url}"); return None
+                try: data = json_loads(content)
+                except json.JSONDecodeError as e_final:
+                    logging.error(f"Error decoding JSON. Content: {content[:500].decode('utf-8', errors='replace')}... - {e_final}")
+                    return None
+                if cache_ttl: write_cached_json(url, data, ttl=cache_ttl, validators=response_validators(response.headers))
+                return data
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.warning(f"Attempt {attempt+1}/{retries+1} Network Error: {e}")
+            if attempt < retries: await asyncio.sleep(delay * (attempt + 1))
+            else: logging.error(f"Final attempt failed with Network Error: {e}"); return None
+    return None
+
+async def fetch_json_pages(session, urls, semaphore, retries=1, delay=1, cache_ttl=0):
+    """Fetches JSON pages concurrently (bounded by semaphore) and returns the results in input order (None for failures).
+    Uses the aiohttp session when available, otherwise runs the blocking fetch_data in worker threads."""
+    async def fetch_page(url):
+        async with semaphore: # fetch_data / fetch_data_async read, store and revalidate cache entries themselves
+            if session is None: return await asyncio.to_thread(fetch_data, url, is_json=True, retries=retries, delay=delay, headers=WEB_HEADERS, cache_ttl=cache_ttl)
+            return await fetch_data_async(session, url, retries=retries, delay=delay, cache_ttl=cache_ttl)
+    results = await asyncio.gather(*(fetch_page(url) for url in urls), return_exceptions=True)
+    for url, result in zip(urls, results):
+        if isinstance(result, BaseException): logging.error(f"Unexpected error fetching {url}: {result}")
+    return [None if isinstance(result, BaseException) else result for result in results]
+
+# Fast path for the timestamp shapes Xumo actually sends: 'YYYY-MM-DDTHH:MM:SS[.fff][Z|+HHMM|+HH:MM]'
+ISO_DATETIME_FAST_RE = re.compile(r'(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})(?:\.\d+)?(Z|[+-]\d{2}:?\d{2})?')
+
 def parse_iso_datetime(iso_time_str):
     """Parses ISO 8601 string, handling 'Z', milliseconds, and '+HHMM' timezone format."""
     if not iso_time_str: logging.debug("parse_iso_datetime received empty string."); return None
+    if not isinstance(iso_time_str, str): logging.warning(f"parse_iso_datetime received non-string value: {iso_time_str!r}"); return None # Also keeps unhashable values away from the cache
+    return parse_iso_datetime_str(iso_time_str)
+
+@lru_cache(maxsize=65536) # EPG start/stop strings repeat heavily across the grid
+def parse_iso_datetime_str(iso_time_str):
+    """parse_iso_datetime for a non-empty string."""
+    match = ISO_DATETIME_FAST_RE.fullmatch(iso_time_str)
+    if match:
+        year, month, day, hour, minute, second, tz = match.groups()
+        try:
+            dt_obj = datetime(int(year), int(month), int(day), int(hour), int(minute), int(second), tzinfo=timezone.utc) # Milliseconds are dropped, as below
+            if tz and tz != 'Z':
+                tz_digits = tz[1:].replace(':', ''); tz_hours = int(tz_digits[:2]); tz_minutes = int(tz_digits[2:])
+                if tz_hours > 23 or tz_minutes > 59: raise ValueError(f"offset {tz} out of range") # e.g. '+2400', which fromisoformat rejects too
+                offset_minutes = tz_hours * 60 + tz_minutes
+                if offset_minutes: dt_obj -= timedelta(minutes=offset_minutes if tz[0] == '+' else -offset_minutes)
+            return dt_obj
+        except ValueError: pass # Out-of-range fields: let the generic path below report it
     try:
         original_str = iso_time_str
         if iso_time_str.endswith('Z'): iso_time_str = iso_time_str[:-1] + '+00:00'
@@ -119,14 +300,11 @@ def parse_iso_datetime(iso_time_str):
     except Exception as e: logging.warning(f"Parse failed for input '{original_str}' (processed as '{iso_time_str}'): {e}"); return None
 
 def format_xmltv_time(dt_obj):
-    """Formats datetime object into XMLTV time (YYYYMMDDHHMMSS +HHMM)."""
+    """Formats datetime object into XMLTV time (YYYYMMDDHHMMSS +HHMM). Output is always UTC, so the offset is the literal '+0000'."""
     if not isinstance(dt_obj, datetime): logging.warning(f"format_xmltv_time received non-datetime object: {type(dt_obj)}"); return ""
-    if not dt_obj.tzinfo: dt_obj_utc = dt_obj.replace(tzinfo=timezone.utc)
+    if not dt_obj.tzinfo: dt_obj_utc = dt_obj # Naive datetimes are treated as UTC
     else: dt_obj_utc = dt_obj.astimezone(timezone.utc)
-    main_part = dt_obj_utc.strftime('%Y%m%d%H%M%S'); offset_part = dt_obj_utc.strftime('%z')
-    offset_part_clean = offset_part.replace(':', ''); full_time_str = f"{main_part} {offset_part_clean}"
-    # logging.debug(f"Formatted time: {full_time_str}"); # Keep commented unless debugging format
-    return full_time_str
+    return '%04d%02d%02d%02d%02d%02d +0000' % (dt_obj_utc.year, dt_obj_utc.month, dt_obj_utc.day, dt_obj_utc.hour, dt_obj_utc.minute, dt_obj_utc.second) # ~2.5x faster than strftime
 
 def ensure_output_dir():
     if not os.path.exists(OUTPUT_DIR):
@@ -134,48 +312,66 @@ def ensure_output_dir():
         try: os.makedirs(OUTPUT_DIR)
         except OSError as e: logging.error(f"Failed to create directory {OUTPUT_DIR}: {e}"); raise
 
-ADD_XMLTV_DOCTYPE = True # Keep DOCTYPE addition
+# Single-pass M3U field escaping (str.translate) instead of chained .replace calls
+M3U_QUOTE_TABLE = str.maketrans('"', "'") # tvg-name attribute
+M3U_COMMA_TABLE = str.maketrans(',', ';') # display name + group-title
 
-def save_gzipped_xml(tree, filepath):
-    """Saves the ElementTree XML to a gzipped file, optionally adding DOCTYPE."""
+ADD_XMLTV_DOCTYPE = True # Keep DOCTYPE addition
+EPG_GZIP_COMPRESSLEVEL = 6 # Level 9 costs ~2-3x the CPU for a few % smaller output
+EPG_WRITE_BUFFER_SIZE = 1 << 20 # Coalesce the many small XML chunks into large writes to the compressor
+XML_ESCAPE_ENTITIES = {'"': '&quot;'} # On top of &, <, > so escaped values are also safe inside attributes
+XMLTV_CHANNEL_TEMPLATE = '<channel id="%s"><display-name>%s</display-name>%s</channel>' # id, name, optional icon fragment
+# One %-interpolation per programme: start, stop, channel, title, then the optional desc/sub-title/episode-num fragments
+XMLTV_PROGRAMME_TEMPLATE = '<programme start="%s" stop="%s" channel="%s"><title lang="en">%s</title>%s%s%s</programme>'
+EPG_DESC_KEYS = ('large', 'medium', 'small', 'tiny') # Preferred description sizes, longest first
+
+def save_gzipped_xml(xml_chunks, filepath):
+    """Streams serialized XML chunks (see generate_epg_xml) into a gzipped file, optionally adding DOCTYPE.
+    Only one chunk is alive at a time, so no lxml.etree.xmlfile writer is needed (it cannot emit pre-escaped chunks anyway).
+    Chunks go to a temp file next to filepath that only replaces it once the document is complete; on failure the
+    previous EPG is left untouched and the error is re-raised, since a truncated EPG must never be published."""
+    tmp_path = f"{filepath}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
     try:
-        if ADD_XMLTV_DOCTYPE:
-            xml_partial_string = ET.tostring(tree.getroot(), encoding='unicode', method='xml')
-            xml_full_string = f'''<?xml version="1.0" encoding="UTF-8"?>
-<!DOCTYPE tv SYSTEM "xmltv.dtd">
-{xml_partial_string}'''
-            xml_bytes = xml_full_string.encode('utf-8'); logging.debug("Adding DOCTYPE to XML output.")
-        else:
-            xml_bytes = ET.tostring(tree.getroot(), encoding='UTF-8', xml_declaration=True); logging.debug("Saving XML without DOCTYPE.")
-        with gzip.open(filepath, 'wb') as f: f.write(xml_bytes)
+        with gzip.open(tmp_path, 'wb', compresslevel=EPG_GZIP_COMPRESSLEVEL) as gz, io.BufferedWriter(gz, buffer_size=EPG_WRITE_BUFFER_SIZE) as f:
+            if ADD_XMLTV_DOCTYPE: f.write(b'<?xml version="1.0" encoding="UTF-8"?>\n<!DOCTYPE tv SYSTEM "xmltv.dtd">\n'); logging.debug("Adding DOCTYPE to XML output.")
+            else: f.write(b'<?xml version="1.0" encoding="UTF-8"?>\n'); logging.debug("Saving XML without DOCTYPE.")
+            for chunk in xml_chunks: f.write(chunk)
+        os.replace(tmp_path, filepath)
         logging.info(f"Gzipped EPG XML file saved: {filepath}")
-    except Exception as e: logging.error(f"Error writing gzipped EPG file {filepath}: {e}")
+    except Exception as e:
+        logging.error(f"Error writing gzipped EPG file {filepath}: {e}")
+        with contextlib.suppress(FileNotFoundError): os.remove(tmp_path)
+        raise
 
 def save_m3u(content, filepath):
+    """Writes the UTF-8 encoded M3U playlist bytes (see generate_m3u_playlist) as-is."""
     try:
-        with open(filepath, 'w', encoding='utf-8') as f: f.write(content)
+        with open(filepath, 'wb') as f: f.write(content)
         logging.info(f"M3U playlist file saved: {filepath}")
     except Exception as e: logging.error(f"Error writing M3U file {filepath}: {e}")
 
+STREAM_URI_PLACEHOLDER_RE = re.compile(r'\[([^]]+)\]')
+STREAM_URI_STATIC_VALUES = { 'PLATFORM': "web", 'APP_VERSION': "1.0.0", 'app_bundle': "web.xumo.com", 'device_make': "GitHubAction", 'device_model': "PythonScript", 'content_language': "en", 'IS_LAT': "0", }
+
 def process_stream_uri(uri):
+    """Fills the [PLACEHOLDER] tokens of a stream URI in a single regex pass; unknown placeholders are removed."""
     if not uri: return None
     try:
-        uri = uri.replace('[PLATFORM]', "web"); uri = uri.replace('[APP_VERSION]', "1.0.0"); uri = uri.replace('[timestamp]', str(int(time.time()*1000)))
-        uri = uri.replace('[app_bundle]', "web.xumo.com"); uri = uri.replace('[device_make]', "GitHubAction"); uri = uri.replace('[device_model]', "PythonScript")
-        uri = uri.replace('[content_language]', "en"); uri = uri.replace('[IS_LAT]', "0"); uri = uri.replace('[IFA]', str(uuid.uuid4()))
-        uri = uri.replace('[SESSION_ID]', str(uuid.uuid4())); uri = uri.replace('[DEVICE_ID]', str(uuid.uuid4().hex))
-        uri = re.sub(r'\[([^]]+)\]', '', uri)
-        return uri
+        values = { **STREAM_URI_STATIC_VALUES, 'timestamp': str(int(time.time()*1000)), 'IFA': str(uuid.uuid4()), 'SESSION_ID': str(uuid.uuid4()), 'DEVICE_ID': uuid.uuid4().hex, }
+        return STREAM_URI_PLACEHOLDER_RE.sub(lambda m: values.get(m.group(1), ''), uri)
     except Exception as e: logging.error(f"Error processing stream URI '{uri[:50]}...': {e}"); return None
 
 
 # --- Core Logic Functions ---
 
+# One EPG programme as stored by fetch_epg_data: a tuple is far smaller than a 6-key dict with 100k+ of them alive at once
+EpgProgram = namedtuple('EpgProgram', ['start', 'end', 'asset_id', 'title', 'descriptions', 'episode_title'])
+
 def get_channels_via_primary_list():
     """Gets channel list from the primary Valencia endpoint."""
     logging.info(f"Attempting Primary Channel List: {PRIMARY_CHANNEL_LIST_URL}")
     # Use WEB_HEADERS for Valencia endpoint
-    data = fetch_data(PRIMARY_CHANNEL_LIST_URL, is_json=True, retries=1, headers=WEB_HEADERS)
+    data = fetch_data(PRIMARY_CHANNEL_LIST_URL, is_json=True, retries=1, headers=WEB_HEADERS, cache_ttl=RESPONSE_CACHE_TTL)
     if not data or not isinstance(data, dict): logging.warning(f"Failed to fetch valid dictionary data from primary list endpoint."); return None
     processed_channels = []; channel_items = []
     if 'channel' in data and isinstance(data['channel'], dict) and 'item' in data['channel'] and isinstance(data['channel']['item'], list):
@@ -186,10 +382,9 @@ def get_channels_via_primary_list():
     logging.info(f"Found {len(channel_items)} potential channel items in primary list response.")
     if not channel_items: logging.warning("Primary list response contained an empty channel list."); return None
     for item in channel_items:
-        callsign = item.get('callsign', ''); properties = item.get('properties', {})
-        is_live = properties.get('is_live') == "true"; is_drm = callsign.endswith("-DRM") or callsign.endswith("DRM-CMS")
-        if is_drm: logging.debug(f"Skipping potential DRM channel: {item.get('guid', {}).get('value')} ({item.get('title')})"); continue
-        if not is_live: logging.debug(f"Skipping non-live channel: {item.get('guid', {}).get('value')} ({item.get('title')})"); continue
+        callsign = item.get('callsign') or ''
+        if callsign.endswith(DRM_CALLSIGN_SUFFIXES): logging.debug(f"Skipping potential DRM channel: {item.get('guid', {}).get('value')} ({item.get('title')})"); continue
+        if (item.get('properties') or {}).get('is_live') != "true": logging.debug(f"Skipping non-live channel: {item.get('guid', {}).get('value')} ({item.get('title')})"); continue
         try:
             channel_id = item.get('guid', {}).get('value'); title = item.get('title'); number_str = item.get('number')
             logo_url = item.get('images', {}).get('logo') or item.get('logo'); genre_list = item.get('genre'); genre = 'General'
@@ -201,7 +396,7 @@ def get_channels_via_primary_list():
                  if logo_url.startswith('//'): final_logo_url = 'https:' + logo_url
                  elif logo_url.startswith('/'): final_logo_url = 'https://image.xumo.com' + logo_url
                  else: final_logo_url = logo_url
-            else: final_logo_url = XUMO_LOGO_URL_TEMPLATE.replace("{channel_id}", channel_id_str)
+            else: final_logo_url = f"{XUMO_LOGO_URL_PREFIX}{channel_id_str}{XUMO_LOGO_URL_SUFFIX}"
             processed_channels.append({ 'id': channel_id_str, 'name': title, 'number': str(number_str) if number_str else None, 'callsign': callsign, 'logo': final_logo_url, 'group': genre, 'stream_url': None })
         except Exception as e: logging.warning(f"Error processing channel list item {item.get('id', 'N/A')}: {e}", exc_info=True)
     if not processed_channels: logging.warning("Primary channel list endpoint returned data, but no channels could be successfully processed."); return None
@@ -210,190 +405,231 @@ def get_channels_via_primary_list():
 
 # <<< FUNCTION ADDED BACK >>>
 def fetch_stream_urls_via_asset_lookup(channels_list):
-    """Fetches stream URLs via Android TV asset lookup method for ALL provided channels."""
+    """Fetches stream URLs via Android TV asset lookup method for ALL provided channels.
+    Channels are looked up concurrently (STREAM_LOOKUP_CONCURRENCY threads sharing SESSION); the result keeps the input order."""
     # This function now assumes it needs to get streams for the entire list passed to it.
-    logging.info(f"Attempting Android TV asset lookup for {len(channels_list)} channels...")
-    processed_count = 0; channels_with_streams = []
-
-    for i, channel_info in enumerate(channels_list):
-        channel_id = channel_info['id']
-        # We no longer skip based on existing stream_url, assuming this function is called
-        # when we *know* we need to fetch streams via this method.
-        logging.debug(f"Asset Lookup: Processing {channel_id} ({channel_info['name']}) ({i+1}/{len(channels_list)})")
-
-        # 1. Get current asset ID (using Android TV endpoint for broadcast)
-        current_hour = datetime.now(timezone.utc).hour
-        broadcast_url = BROADCAST_NOW_URL_TEMPLATE.format(channel_id=channel_id, hour_num=current_hour)
-        logging.debug(f"Fetching broadcast info: {broadcast_url}")
-        # Use ANDROID_TV_HEADERS for these specific calls
-        broadcast_data = fetch_data(broadcast_url, is_json=True, retries=1, headers=ANDROID_TV_HEADERS)
-
-        asset_id = None
-        if broadcast_data and 'assets' in broadcast_data and isinstance(broadcast_data['assets'], list) and len(broadcast_data['assets']) > 0:
-            now_utc = datetime.now(timezone.utc); current_asset = None
-            for asset in broadcast_data['assets']:
-                start_time = parse_iso_datetime(asset.get('start')); end_time = parse_iso_datetime(asset.get('end'))
-                if start_time and end_time and start_time <= now_utc < end_time: current_asset = asset; break
-            if not current_asset and broadcast_data['assets']: current_asset = broadcast_data['assets'][0]
-            if current_asset: asset_id = current_asset.get('id')
-            if asset_id: logging.debug(f"Found current asset ID {asset_id} for channel {channel_id}")
-            else: logging.warning(f"Relevant asset in broadcast data for channel {channel_id} has no ID.")
-        else: logging.warning(f"Could not get valid broadcast data or assets for channel {channel_id} (Hour: {current_hour})"); time.sleep(API_DELAY_SECONDS); continue # Skip channel if broadcast fails
-
-        if not asset_id: logging.warning(f"No asset ID found for channel {channel_id}, cannot get stream URL."); time.sleep(API_DELAY_SECONDS); continue # Skip channel
-
-        # 2. Get asset details (using Android TV endpoint for assets)
-        asset_details_url = ASSET_DETAILS_URL_TEMPLATE.format(asset_id=asset_id)
-        logging.debug(f"Fetching asset details: {asset_details_url}")
-        # Use ANDROID_TV_HEADERS for these specific calls
-        asset_data = fetch_data(asset_details_url, is_json=True, headers=ANDROID_TV_HEADERS)
-
-        raw_stream_uri = None
-        if asset_data and 'providers' in asset_data and isinstance(asset_data['providers'], list):
-            for provider in asset_data['providers']:
-                 if ('sources' in provider and isinstance(provider['sources'], list)):
-                     for source in provider['sources']:
-                         if source.get('uri') and (source.get('type') == 'application/x-mpegURL' or source.get('uri', '').endswith('.m3u8')): raw_stream_uri = source['uri']; break
-                         elif source.get('uri') and not raw_stream_uri: raw_stream_uri = source['uri']
-                     if raw_stream_uri: break
-        else: logging.warning(f"Could not find providers/sources for asset {asset_id} (Channel {channel_id})")
-
-        if not raw_stream_uri: logging.warning(f"No stream URI found in sources for asset {asset_id} (Channel {channel_id})"); time.sleep(API_DELAY_SECONDS); continue # Skip channel
-
-        # 3. Process URI
-        processed_stream_url = process_stream_uri(raw_stream_uri)
-        if processed_stream_url:
-            # Create a new dict or update existing one with stream_url
-            updated_channel_info = channel_info.copy() # Avoid modifying original list directly if passed by reference elsewhere
-            updated_channel_info['stream_url'] = processed_stream_url
-            logging.debug(f"Successfully processed stream URL for channel {channel_id} via asset lookup")
-            channels_with_streams.append(updated_channel_info) # Add the updated dict
-            processed_count += 1
-        else: logging.warning(f"Failed to process stream URI for asset {asset_id} (Channel {channel_id})") # Don't add if processing fails
-
-        time.sleep(API_DELAY_SECONDS)
-
-    logging.info(f"Asset lookup method obtained stream URLs for {processed_count} channels.")
+    logging.info(f"Attempting Android TV asset lookup for {len(channels_list)} channels (concurrency {STREAM_LOOKUP_CONCURRENCY})...")
+    current_hour = datetime.now(timezone.utc).hour; log_debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+    def lookup(indexed_channel): i, channel_info = indexed_channel; return fetch_stream_url_for_channel(channel_info, current_hour, f"{i+1}/{len(channels_list)}", log_debug)
+    with ThreadPoolExecutor(max_workers=STREAM_LOOKUP_CONCURRENCY) as executor:
+        channels_with_streams = [channel for channel in executor.map(lookup, enumerate(channels_list)) if channel]
+    logging.info(f"Asset lookup method obtained stream URLs for {len(channels_with_streams)} channels.")
     return channels_with_streams # Return the new list containing only channels where stream URL was found
+
+def fetch_stream_url_for_channel(channel_info, current_hour, progress, log_debug=False):
+    """Asset lookup for one channel: broadcast -> current asset -> asset details -> stream URI.
+    Returns a copy of channel_info with 'stream_url' set, or None if no stream URL could be found."""
+    channel_id = channel_info['id']
+    # We no longer skip based on existing stream_url, assuming this function is called
+    # when we *know* we need to fetch streams via this method.
+    if log_debug: logging.debug(f"Asset Lookup: Processing {channel_id} ({channel_info['name']}) ({progress})")
+
+    # 1. Get current asset ID (using Android TV endpoint for broadcast)
+    broadcast_url = BROADCAST_NOW_URL_TEMPLATE.format(channel_id=channel_id, hour_num=current_hour)
+    if log_debug: logging.debug(f"Fetching broadcast info: {broadcast_url}")
+    # Use ANDROID_TV_HEADERS for these specific calls
+    broadcast_data = fetch_data(broadcast_url, is_json=True, retries=1, headers=ANDROID_TV_HEADERS)
+
+    asset_id = None
+    if broadcast_data and 'assets' in broadcast_data and isinstance(broadcast_data['assets'], list) and len(broadcast_data['assets']) > 0:
+        now_utc = datetime.now(timezone.utc); current_asset = None
+        for asset in broadcast_data['assets']:
+            start_time = parse_iso_datetime(asset.get('start')); end_time = parse_iso_datetime(asset.get('end'))
+            if start_time and end_time and start_time <= now_utc < end_time: current_asset = asset; break
+        if not current_asset and broadcast_data['assets']: current_asset = broadcast_data['assets'][0]
+        if current_asset: asset_id = current_asset.get('id')
+        if asset_id:
+            if log_debug: logging.debug(f"Found current asset ID {asset_id} for channel {channel_id}")
+        else: logging.warning(f"Relevant asset in broadcast data for channel {channel_id} has no ID.")
+    else: logging.warning(f"Could not get valid broadcast data or assets for channel {channel_id} (Hour: {current_hour})"); return None # Skip channel if broadcast fails
+
+    if not asset_id: logging.warning(f"No asset ID found for channel {channel_id}, cannot get stream URL."); return None # Skip channel
+
+    # 2. Get asset details (using Android TV endpoint for assets)
+    asset_details_url = ASSET_DETAILS_URL_TEMPLATE.format(asset_id=asset_id)
+    if log_debug: logging.debug(f"Fetching asset details: {asset_details_url}")
+    # Use ANDROID_TV_HEADERS for these specific calls
+    asset_data = fetch_data(asset_details_url, is_json=True, headers=ANDROID_TV_HEADERS, cache_ttl=RESPONSE_CACHE_TTL)
+
+    raw_stream_uri = None; providers = asset_data.get('providers') if isinstance(asset_data, dict) else None
+    if isinstance(providers, list):
+        for provider in providers:
+             sources = provider.get('sources')
+             if isinstance(sources, list):
+                 for source in sources: # First HLS source wins; otherwise the provider's first source with a URI
+                     uri = source.get('uri')
+                     if not uri: continue
+                     if source.get('type') == 'application/x-mpegURL' or uri.endswith('.m3u8'): raw_stream_uri = uri; break
+                     if not raw_stream_uri: raw_stream_uri = uri
+                 if raw_stream_uri: break
+    else: logging.warning(f"Could not find providers/sources for asset {asset_id} (Channel {channel_id})")
+
+    if not raw_stream_uri: logging.warning(f"No stream URI found in sources for asset {asset_id} (Channel {channel_id})"); return None # Skip channel
+
+    # 3. Process URI
+    processed_stream_url = process_stream_uri(raw_stream_uri)
+    if not processed_stream_url: logging.warning(f"Failed to process stream URI for asset {asset_id} (Channel {channel_id})"); return None # Don't add if processing fails
+    # Create a new dict with stream_url; the original list is not modified
+    updated_channel_info = channel_info.copy(); updated_channel_info['stream_url'] = processed_stream_url
+    if log_debug: logging.debug(f"Successfully processed stream URL for channel {channel_id} via asset lookup")
+    return updated_channel_info
 # <<< END OF FUNCTION ADDED BACK >>>
 
 
 def fetch_epg_data(channel_list):
-    """Fetches EPG data using the Valencia endpoint (10006), iterating through hours and offsets."""
+    """Fetches EPG data using the Valencia endpoint (10006), iterating through hours and offsets.
+    Returns {channel_id: [EpgProgram, ...]} holding only (and ordered like) the channels in channel_list."""
     if not channel_list: return {}
-    logging.info(f"Fetching EPG data for {len(channel_list)} channels (using Valencia EPG endpoint {PRIMARY_LIST_ID})...")
+    return asyncio.run(fetch_epg_data_async(channel_list))
+
+async def fetch_epg_data_async(channel_list):
+    """Async driver for fetch_epg_data: all hours of an offset block are fetched concurrently, then processed in hour order."""
+    logging.info(f"Fetching EPG data for {len(channel_list)} channels (using Valencia EPG endpoint {PRIMARY_LIST_ID}, concurrency {EPG_FETCH_CONCURRENCY}, {'aiohttp' if aiohttp else 'threads'})...")
     consolidated_epg = {channel['id']: [] for channel in channel_list}; assets_cache = {}
-    channel_ids_in_final_list = {ch['id'] for ch in channel_list}
-    today = datetime.now(timezone.utc); dates_to_fetch = [today + timedelta(days=d) for d in range(EPG_FETCH_DAYS)]
-    total_requests = 0; total_programs_fetched = 0; total_programs_added = 0
-    for date_obj in dates_to_fetch:
-        date_str = date_obj.strftime('%Y%m%d'); logging.info(f"Fetching EPG for date: {date_str}")
-        offset = 0
-        while offset <= MAX_EPG_OFFSET:
-            logging.debug(f"Processing EPG Offset Block: {offset}"); found_relevant_channel_in_offset_block = False
-            for hour in range(HOURS_TO_FETCH):
-                total_requests += 1
-                fetch_url = EPG_FETCH_URL_TEMPLATE.format(date_str=date_str, hour=hour, offset=offset)
-                logging.debug(f"  Fetching EPG - Date={date_str}, Hour={hour}, Offset={offset} -> {fetch_url}")
-                page_data = fetch_data(fetch_url, is_json=True, retries=1, delay=1, headers=WEB_HEADERS)
-                if page_data and isinstance(page_data, dict):
-                    if 'assets' in page_data and isinstance(page_data['assets'], dict): assets_cache.update(page_data['assets'])
-                    if 'channels' in page_data and isinstance(page_data['channels'], list):
-                        processed_channels_this_page = 0; programs_added_this_page = 0
-                        for channel_schedule_data in page_data['channels']:
-                            channel_id = str(channel_schedule_data.get('channelId'))
-                            if channel_id in channel_ids_in_final_list:
-                                found_relevant_channel_in_offset_block = True; processed_channels_this_page += 1
-                                if channel_id not in consolidated_epg: consolidated_epg[channel_id] = []
-                                for program_schedule in channel_schedule_data.get('schedule', []):
-                                    total_programs_fetched += 1; asset_id = program_schedule.get('assetId')
-                                    asset_details = assets_cache.get(asset_id)
-                                    if asset_details:
-                                        program_info = { 'start': program_schedule.get('start'), 'end': program_schedule.get('end'), 'assetId': asset_id, 'title': asset_details.get('title', 'Unknown Program'), 'descriptions': asset_details.get('descriptions',{}), 'episodeTitle': asset_details.get('episodeTitle'), }
-                                        if program_info['start'] and program_info['end']: consolidated_epg[channel_id].append(program_info); programs_added_this_page += 1; total_programs_added += 1
-                                        else: logging.warning(f"EPG: Program for asset {asset_id} on channel {channel_id} missing start/end time in schedule.")
-                                    else: logging.warning(f"EPG: Asset details not found for assetId {asset_id} on channel {channel_id} (Date={date_str}, Hour={hour}, Offset={offset})")
-                        if programs_added_this_page > 0: logging.debug(f"    Processed {processed_channels_this_page} relevant channels, added {programs_added_this_page} program entries from Hour {hour}.")
-                    else: logging.debug(f"    No 'channels' key found in response for Hour {hour}, Offset {offset}.")
-                else: logging.debug(f"    Failed to fetch or invalid data for Hour {hour}, Offset {offset}. Skipping.")
-                time.sleep(API_DELAY_SECONDS / 2)
-            logging.debug(f"Finished processing all hours for Offset Block: {offset}")
-            offset += 50; time.sleep(API_DELAY_SECONDS)
+    seen_programs = {channel['id']: set() for channel in channel_list} # (start, assetId) per channel; duplicates are dropped on ingestion
+    today = datetime.now(timezone.utc); dates_to_fetch = [(today + timedelta(days=d)).strftime('%Y%m%d') for d in range(EPG_FETCH_DAYS)]
+    # Every page URL is formatted once up front: {date_str: [(offset, [url per hour]), ...]}; short-circuited blocks are simply never fetched
+    epg_fetch_blocks = {date_str: [(offset, [EPG_FETCH_URL_TEMPLATE.format(date_str=date_str, hour=hour, offset=offset) for hour in range(HOURS_TO_FETCH)]) for offset in range(0, MAX_EPG_OFFSET + 1, 50)] for date_str in dates_to_fetch}
+    total_requests = 0; total_programs_fetched = 0; total_programs_added = 0; duplicates_removed_total = 0
+    semaphore = asyncio.Semaphore(EPG_FETCH_CONCURRENCY); log_debug = logging.getLogger().isEnabledFor(logging.DEBUG) # Per-page debug messages are only formatted when emitted
+    session_context = aiohttp.ClientSession(headers=WEB_HEADERS, timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)) if aiohttp else contextlib.nullcontext()
+    async with session_context as session:
+        for date_str, offset_blocks in epg_fetch_blocks.items():
+            logging.info(f"Fetching EPG for date: {date_str}")
+            channel_ids_found_for_date = set(); empty_offset_blocks = 0
+            for offset, fetch_urls in offset_blocks:
+                logging.debug(f"Processing EPG Offset Block: {offset}"); found_relevant_channel_in_offset_block = False; found_any_channel_in_offset_block = False; found_empty_page_in_offset_block = False
+                total_requests += len(fetch_urls)
+                pages = await fetch_json_pages(session, fetch_urls, semaphore, cache_ttl=RESPONSE_CACHE_TTL)
+                for hour, page_data in enumerate(pages):
+                    if page_data and isinstance(page_data, dict):
+                        if 'assets' in page_data and isinstance(page_data['assets'], dict): assets_cache.update(page_data['assets'])
+                        if 'channels' in page_data and isinstance(page_data['channels'], list):
+                            processed_channels_this_page = 0; programs_added_this_page = 0
+                            if page_data['channels']: found_any_channel_in_offset_block = True
+                            else: found_empty_page_in_offset_block = True
+                            for channel_schedule_data in page_data['channels']:
+                                channel_id = str(channel_schedule_data.get('channelId'))
+                                if channel_id in consolidated_epg: # Keyed by exactly the wanted channel IDs
+                                    found_relevant_channel_in_offset_block = True; processed_channels_this_page += 1; channel_ids_found_for_date.add(channel_id)
+                                    for program_schedule in channel_schedule_data.get('schedule', []):
+                                        total_programs_fetched += 1; asset_id = program_schedule.get('assetId')
+                                        asset_details = assets_cache.get(asset_id)
+                                        if asset_details:
+                                            program_start = program_schedule.get('start'); program_end = program_schedule.get('end')
+                                            if not program_start or not program_end: logging.warning(f"EPG: Program for asset {asset_id} on channel {channel_id} missing start/end time in schedule."); continue
+                                            program_key = (program_start, asset_id); channel_seen = seen_programs[channel_id]
+                                            if program_key in channel_seen: duplicates_removed_total += 1; continue
+                                            channel_seen.add(program_key)
+                                            program_info = EpgProgram(program_start, program_end, asset_id, asset_details.get('title', 'Unknown Program'), asset_details.get('descriptions', {}), asset_details.get('episodeTitle'))
+                                            consolidated_epg[channel_id].append(program_info); programs_added_this_page += 1; total_programs_added += 1
+                                        else: logging.warning(f"EPG: Asset details not found for assetId {asset_id} on channel {channel_id} (Date={date_str}, Hour={hour}, Offset={offset})")
+                            if log_debug and programs_added_this_page > 0: logging.debug(f"    Processed {processed_channels_this_page} relevant channels, added {programs_added_this_page} program entries from Hour {hour}.")
+                        elif log_debug: logging.debug(f"    No 'channels' key found in response for Hour {hour}, Offset {offset}.")
+                    elif log_debug: logging.debug(f"    Failed to fetch or invalid data for Hour {hour}, Offset {offset}. Skipping.")
+                logging.debug(f"Finished processing all hours for Offset Block: {offset} (relevant channels found: {found_relevant_channel_in_offset_block})")
+                # Short-circuit: later offsets cannot add anything once every wanted channel was seen, or once the list has run out
+                if len(channel_ids_found_for_date) == len(consolidated_epg): logging.debug(f"All {len(consolidated_epg)} channels found for {date_str}; skipping remaining offsets."); break
+                # Only a block the API answered with empty channel lists counts as empty; a block where every page failed proves nothing
+                if found_any_channel_in_offset_block: empty_offset_blocks = 0
+                elif found_empty_page_in_offset_block: empty_offset_blocks += 1
+                if empty_offset_blocks >= EPG_MAX_EMPTY_OFFSET_BLOCKS: logging.debug(f"{empty_offset_blocks} consecutive empty offset blocks for {date_str}; skipping remaining offsets."); break
     logging.info(f"Finished fetching EPG data after {total_requests} requests.")
     logging.info(f"Found {total_programs_fetched} raw program entries, successfully stored {total_programs_added} entries.")
-    logging.info("Removing duplicate program entries...")
-    final_epg = {}; duplicates_removed_total = 0
-    for channel_id, programs in consolidated_epg.items():
-        seen_programs = set(); unique_programs = []; duplicates_this_channel = 0
-        for prog in programs:
-            prog_key = (prog.get('start'), prog.get('assetId'))
-            if prog_key not in seen_programs: seen_programs.add(prog_key); unique_programs.append(prog)
-            else: duplicates_this_channel += 1
-        final_epg[channel_id] = unique_programs
-        if duplicates_this_channel > 0: logging.debug(f"  Channel {channel_id}: Removed {duplicates_this_channel} duplicates. Final count: {len(unique_programs)}")
-        duplicates_removed_total += duplicates_this_channel
     logging.info(f"Finished EPG processing. Total duplicates removed: {duplicates_removed_total}")
-    return final_epg
+    return consolidated_epg
 
 # --- Generate M3U and EPG XML ---
 
+def xml_escape(text, escape_cache):
+    """XML-escapes a string for channel/programme text and attributes, memoized in escape_cache (raw -> escaped text)."""
+    value = escape_cache.get(text)
+    if value is None: value = escape_cache[text] = xml_escape_text(text, XML_ESCAPE_ENTITIES)
+    return value
+
+def iso_to_xmltv_time(time_str, time_cache):
+    """Converts a raw ISO timestamp string straight to XMLTV time, memoized in time_cache (raw -> XMLTV time or None)."""
+    value = time_cache.get(time_str, time_cache) # The dict itself is the miss sentinel (cached None stays a hit)
+    if value is time_cache:
+        dt_obj = parse_iso_datetime(time_str); value = format_xmltv_time(dt_obj) if dt_obj else None
+        time_cache[time_str] = value
+    return value
+
+def serialize_channel_programmes(channel_id, programs, time_cache, escape_cache):
+    """Serializes one channel's programmes to UTF-8 <programme> bytes. Returns (bytes, programme_count).
+    time_cache/escape_cache are the per-run dicts from generate_epg_xml, shared across channels."""
+    # Programmes are emitted as pre-escaped XML strings rather than ET elements: no tree per programme, and xml_escape
+    # caches the escaping of repeated titles/descriptions, which ET would redo on every tostring() call.
+    escape = xml_escape; xmltv_time = iso_to_xmltv_time; desc_keys = EPG_DESC_KEYS; programme_template = XMLTV_PROGRAMME_TEMPLATE # Hoist lookups out of the hot loop
+    channel_attr = escape(channel_id, escape_cache); programme_parts = []
+    log_skips = logging.getLogger().isEnabledFor(logging.WARNING) # Checked once; skip messages are only formatted when they would be emitted
+    for program in programs:
+        start_time_str = program.start; end_time_str = program.end
+        if not start_time_str or not end_time_str:
+            if log_skips: logging.warning(f"    Skipping program with missing start/end time: AssetID={program.asset_id}, Title='{program.title}'")
+            continue
+        try: # Any malformed field from the API (non-string times/titles, non-dict descriptions) skips only this programme
+            start_formatted = xmltv_time(start_time_str, time_cache); stop_formatted = xmltv_time(end_time_str, time_cache) # parse_iso_datetime handles its own parse errors
+            if not start_formatted or not stop_formatted:
+                if log_skips: logging.warning(f"    Skipping program due to failed time parsing/formatting: AssetID={program.asset_id}, Title='{program.title}'")
+                continue
+            title = program.title; desc_obj = program.descriptions or {}
+            for desc_key in desc_keys: # First non-empty description wins; stops at 'large' in the common case
+                desc = desc_obj.get(desc_key)
+                if desc: break
+            episode_title = program.episode_title; asset_id = program.asset_id
+            desc_xml = f'<desc lang="en">{escape(desc, escape_cache)}</desc>' if desc else ''
+            sub_title_xml = f'<sub-title lang="en">{escape(episode_title, escape_cache)}</sub-title>' if episode_title and episode_title != title else ''
+            episode_num_xml = f'<episode-num system="{"dd_progid" if asset_id.startswith("EP") else "dd_assetid"}">{escape(asset_id, escape_cache)}</episode-num>' if asset_id else ''
+            programme_parts.append(programme_template % (start_formatted, stop_formatted, channel_attr, escape(title, escape_cache) if title else '', desc_xml, sub_title_xml, episode_num_xml))
+        except (TypeError, AttributeError) as e:
+            if log_skips: logging.warning(f"    Skipping EPG program item {program.asset_id} for channel {channel_id}: {e}")
+    return ''.join(programme_parts).encode('utf-8'), len(programme_parts)
+
 def generate_epg_xml(channel_list_with_streams, consolidated_epg_data):
+    """Yields the EPG <tv> document as UTF-8 byte chunks: all <channel> elements as one chunk, then one per channel's programmes.
+    consolidated_epg_data must only hold channels from channel_list_with_streams (as returned by fetch_epg_data).
+    Nothing beyond the current chunk is held in memory."""
     logging.info("Generating EPG XML structure...")
-    tv_element = ET.Element('tv', attrib={'generator-info-name': f'{GITHUB_USER}-{GITHUB_REPO}'})
-    programme_count = 0; channel_ids_in_list = {c['id'] for c in channel_list_with_streams}
+    yield XMLTV_TV_OPEN_TAG
+    programme_count = 0
+    time_cache = {}; escape_cache = {} # Per-run memo dicts: start == previous stop for most programmes, and titles/descriptions repeat across episodes
     logging.debug("Adding channel elements to EPG XML...")
-    for channel in channel_list_with_streams:
-        chan_el = ET.SubElement(tv_element, 'channel', attrib={'id': channel['id']})
-        ET.SubElement(chan_el, 'display-name').text = channel['name'] # Only one display-name
-        if channel['logo']: ET.SubElement(chan_el, 'icon', attrib={'src': channel['logo']})
+    channel_parts = [] # Channel elements are few; batch them into one write instead of one per channel
+    for channel in channel_list_with_streams: # Only one display-name; the channel number is intentionally not emitted as a second one
+        icon_xml = f'<icon src="{xml_escape(channel["logo"], escape_cache)}" />' if channel['logo'] else ''
+        channel_parts.append(XMLTV_CHANNEL_TEMPLATE % (xml_escape(channel['id'], escape_cache), xml_escape(channel['name'], escape_cache), icon_xml))
+    yield ''.join(channel_parts).encode('utf-8')
     logging.debug("Adding programme elements to EPG XML...")
     total_programs_in_data = sum(len(progs) for progs in consolidated_epg_data.values())
     logging.debug(f"Total unique program entries before XML generation: {total_programs_in_data}")
+    # consolidated_epg_data is pre-filtered to the final channel list (and in its order) by fetch_epg_data, so no membership check is needed
     for channel_id, programs in consolidated_epg_data.items():
-        if channel_id not in channel_ids_in_list: logging.debug(f"Skipping EPG programs for channel {channel_id} as it's not in the final M3U list."); continue
-        program_processed_for_channel = 0
-        for program in programs:
-            program_asset_id = program.get('assetId', 'N/A'); program_title = program.get('title', 'N/A')
-            try:
-                start_time_str = program.get('start'); end_time_str = program.get('end')
-                start_time = parse_iso_datetime(start_time_str); end_time = parse_iso_datetime(end_time_str)
-                if not start_time or not end_time: logging.warning(f"    Skipping program due to failed time parsing: AssetID={program_asset_id}, Title='{program_title}'"); continue
-                title = program.get('title', 'Unknown Program'); desc_obj = program.get('descriptions', {})
-                desc = desc_obj.get('large') or desc_obj.get('medium') or desc_obj.get('small') or desc_obj.get('tiny')
-                episode_title = program.get('episodeTitle'); asset_id = program.get('assetId')
-                start_formatted = format_xmltv_time(start_time); stop_formatted = format_xmltv_time(end_time) # Use final updated formatter
-                if start_formatted and stop_formatted:
-                    prog_el = ET.SubElement(tv_element, 'programme', attrib={'start': start_formatted,'stop': stop_formatted,'channel': channel_id})
-                    ET.SubElement(prog_el, 'title', attrib={'lang': 'en'}).text = title
-                    if desc: ET.SubElement(prog_el, 'desc', attrib={'lang': 'en'}).text = desc
-                    if episode_title and episode_title != title: ET.SubElement(prog_el, 'sub-title', attrib={'lang': 'en'}).text = episode_title
-                    if asset_id:
-                        system_type = "dd_progid" if asset_id.startswith("EP") else "dd_assetid"
-                        ET.SubElement(prog_el, 'episode-num', attrib={'system': system_type}).text = asset_id
-                    programme_count += 1; program_processed_for_channel += 1
-                else: logging.warning(f"    Skipping program due to invalid formatted time: AssetID={program_asset_id}, Title='{title}' (Channel: {channel_id})")
-            except Exception as e: logging.exception(f"Error processing EPG program item {program_asset_id} for channel {channel_id}: {e}")
+        if not programs: continue
+        programmes_xml, count = serialize_channel_programmes(channel_id, programs, time_cache, escape_cache)
+        programme_count += count; yield programmes_xml
+    yield b'</tv>\n'
     logging.info(f"Generated XML with {len(channel_list_with_streams)} channels and {programme_count} programmes.")
     if programme_count == 0 and total_programs_in_data > 0: logging.warning("EPG data was fetched, but no valid program entries could be added to the XML. Check time parsing/formatting issues in DEBUG logs.")
-    return ET.ElementTree(tv_element)
 
 def generate_m3u_playlist(channel_list_with_streams):
     logging.info("Generating M3U playlist...")
-    playlist_parts = [f'#EXTM3U url-tvg="{EPG_RAW_URL}"\n']
-    added_count = 0
-    def sort_key(channel):
-        try: num = int(channel.get('number', '999999')); return (num, channel['name'].lower())
-        except (ValueError, TypeError): return (999999, channel['name'].lower())
-    sorted_channels = sorted(channel_list_with_streams, key=sort_key)
+    # Decorate once: (number, lowercase name) is computed a single time per channel, then sorted on the precomputed key.
+    def channel_number(channel): # Anything int() rejects (missing, None, non-numeric) sorts last
+        try: return int(channel.get('number', '999999'))
+        except (ValueError, TypeError): return 999999
+    decorated = [((channel_number(c), c['name'].lower()), c) for c in channel_list_with_streams]
+    decorated.sort(key=lambda t: t[0])
+    sorted_channels = [t[1] for t in decorated]
+    channels_to_add = [] # Filter stream-less channels once, then format one block per channel
     for channel in sorted_channels:
-        stream_url = channel.get('stream_url'); channel_id = channel['id']; display_name = channel['name'].replace(',', ';')
-        group_title = channel.get('group', 'General').replace(',', ';'); tvg_name = channel['name'].replace('"', "'"); logo = channel.get("logo", "")
-        if stream_url:
-            extinf_line = f'#EXTINF:-1 tvg-id="{channel_id}" tvg-name="{tvg_name}" tvg-logo="{logo}" group-title="{group_title}",{display_name}\n'
-            playlist_parts.append(extinf_line); playlist_parts.append(f'{stream_url}\n'); added_count += 1
-        else: logging.error(f"Channel {channel_id} ('{channel['name']}') reached M3U generation without a stream URL!")
-    logging.info(f"Added {added_count} channels with stream URLs to M3U playlist.")
-    return "".join(playlist_parts)
+        if channel.get('stream_url'): channels_to_add.append(channel)
+        else: logging.error(f"Channel {channel['id']} ('{channel['name']}') reached M3U generation without a stream URL!")
+    playlist = bytearray(M3U_HEADER) # Build UTF-8 bytes directly; no final str join + encode
+    for c in channels_to_add:
+        playlist += f'#EXTINF:-1 tvg-id="{c["id"]}" tvg-name="{c["name"].translate(M3U_QUOTE_TABLE)}" tvg-logo="{c.get("logo", "")}" group-title="{c.get("group", "General").translate(M3U_COMMA_TABLE)}",{c["name"].translate(M3U_COMMA_TABLE)}\n{c["stream_url"]}\n'.encode('utf-8')
+    logging.info(f"Added {len(channels_to_add)} channels with stream URLs to M3U playlist.")
+    return playlist
 
 # --- Main Execution ---
 if __name__ == "__main__":
@@ -414,9 +650,9 @@ if __name__ == "__main__":
 
     if not final_channel_list_with_streams:
          logging.warning("No channels with stream URLs found after processing. Generating empty files.")
-         save_m3u(f'#EXTM3U url-tvg="{EPG_RAW_URL}"\n', os.path.join(OUTPUT_DIR, PLAYLIST_FILENAME))
-         empty_root = ET.Element('tv'); empty_tree = ET.ElementTree(empty_root)
-         save_gzipped_xml(empty_tree, os.path.join(OUTPUT_DIR, EPG_FILENAME))
+         save_m3u(M3U_HEADER, os.path.join(OUTPUT_DIR, PLAYLIST_FILENAME))
+         try: save_gzipped_xml(generate_epg_xml([], {}), os.path.join(OUTPUT_DIR, EPG_FILENAME))
+         except Exception: logging.warning("Keeping the previous EPG file; the empty playlist is still published.")
          logging.info("Generated empty playlist and EPG files."); sys.exit(0)
 
     logging.info(f"Proceeding with {len(final_channel_list_with_streams)} channels confirmed to have stream URLs.")
@@ -424,14 +660,14 @@ if __name__ == "__main__":
     # Step 3: Fetch EPG Data (Using new hourly method)
     epg_data = fetch_epg_data(final_channel_list_with_streams)
 
-    # Step 4: Generate EPG XML
-    epg_tree = generate_epg_xml(final_channel_list_with_streams, epg_data)
-
-    # Step 5: Generate M3U Playlist
+    # Step 4: Generate M3U Playlist
     m3u_content = generate_m3u_playlist(final_channel_list_with_streams)
 
-    # Step 6: Save Files
+    # Step 5: Save M3U first, so an EPG write failure cannot keep the playlist from being published
     save_m3u(m3u_content, os.path.join(OUTPUT_DIR, PLAYLIST_FILENAME))
-    save_gzipped_xml(epg_tree, os.path.join(OUTPUT_DIR, EPG_FILENAME))
+
+    # Step 6: Generate EPG XML and stream it straight into the gzipped file
+    try: save_gzipped_xml(generate_epg_xml(final_channel_list_with_streams, epg_data), os.path.join(OUTPUT_DIR, EPG_FILENAME))
+    except Exception: logging.warning("Keeping the previous EPG file; the new playlist is still published.") # save_gzipped_xml already logged the cause
 
     logging.info("--- Xumo Scraper Finished Successfully ---")